@@ -1,9 +1,9 @@
 import os
-import time
+import asyncio
 import logging
 from dotenv import load_dotenv
 import google.genai as genai
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -14,55 +14,69 @@ if not GEMINI_API_KEYS:
     raise RuntimeError("請先設定 GEMINI_API_KEY")
 
 # 控制同一個 key 底下同時刪幾個檔
-MAX_WORKERS_PER_KEY = 8  # 你可以調大或調小
+# google-genai 沒有 batch delete，改用 client.aio 在同一條連線上管線化送出
+MAX_CONCURRENT_DELETES_PER_KEY = 16  # 你可以調大或調小
 
 
-def delete_one_file(client: genai.Client, file_name: str):
+async def delete_one_file(client: genai.Client, sem: asyncio.Semaphore, file_name: str):
     """刪一個檔案，失敗不丟出到外面"""
+    async with sem:
+        try:
+            await client.aio.files.delete(name=file_name)
+            logging.info(f"🗑️ 刪除 {file_name}")
+        except Exception as e:
+            logging.warning(f"⚠️ 刪除失敗 {file_name}: {e}")
+
+
+async def delete_all_files_async(client: genai.Client, prefix: str):
+    """
+    邊列檔案邊刪：每拿到一頁就把刪除丟出去，不用等全部列完
+    用 semaphore 限流
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENT_DELETES_PER_KEY)
+    tasks = []
+
+    # 1) 列出檔案，同時排入刪除
+    list_failed = False
     try:
-        client.files.delete(name=file_name)
-        logging.info(f"🗑️ 刪除 {file_name}")
-    except Exception as e:
-        logging.warning(f"⚠️ 刪除失敗 {file_name}: {e}")
-
-
-def delete_all_files_for_key(api_key: str):
-    prefix = f"[{api_key[:10]}...]"
-    client = genai.Client(api_key=api_key)
-
-    # 1) 列出檔案
-    try:
-        files = client.files.list()
+        async for f in await client.aio.files.list():
+            tasks.append(asyncio.create_task(delete_one_file(client, sem, f.name)))
+            if len(tasks) % 100 == 0:
+                logging.info(f"{prefix} 已排入 {len(tasks)} 個檔案...")
     except Exception as e:
         logging.error(f"{prefix} 無法列出檔案：{e}")
-        return
+        list_failed = True
 
-    if not files:
-        logging.info(f"{prefix} ✅ 沒有可刪除的檔案")
+    if not tasks:
+        # 第一頁就列不出來的話不能說「沒有檔案」，上面已經記過錯誤了
+        if not list_failed:
+            logging.info(f"{prefix} ✅ 沒有可刪除的檔案")
         return
 
-    logging.info(f"{prefix} 找到 {len(files)} 個檔案，準備刪除（並行）...")
-
-    # 2) 並行刪除
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS_PER_KEY) as executor:
-        futures = []
-        for f in files:
-            futures.append(executor.submit(delete_one_file, client, f.name))
+    # 2) 等全部刪完（失敗的在 delete_one_file 裡吃掉）
+    await asyncio.gather(*tasks)
+    if list_failed:
+        logging.error(f"{prefix} ❌ 列檔案中途失敗，只處理了已列出的 {len(tasks)} 個檔案，可能還有沒刪到的")
+    else:
+        logging.info(f"{prefix} ✅ 這個 key 底下的 {len(tasks)} 個檔案都處理完了")
 
-        # 等全部做完（順便吃掉 exception）
-        for _ in as_completed(futures):
-            pass
 
-    logging.info(f"{prefix} ✅ 這個 key 底下的檔案都處理完了")
+def delete_all_files_for_key(api_key: str):
+    prefix = f"[{api_key[:10]}...]"
+    client = genai.Client(api_key=api_key)
+    asyncio.run(delete_all_files_async(client, prefix))
 
 
 def main():
-    # 如果你想「多個 key 也一起並行」可以再包一層 ThreadPool
-    # 這裡先簡單：逐個 key 處理，已經有檔案層級的並行了
-    for key in GEMINI_API_KEYS:
-        delete_all_files_for_key(key)
-        # 視情況稍微休息，避免真的打太兇
-        time.sleep(0.5)
+    # 每個 key 的 quota 是獨立的，所以 key 之間也一起並行
+    # 外層：key 層級的並行；內層：檔案層級的並行（MAX_CONCURRENT_DELETES_PER_KEY）
+    with ThreadPoolExecutor(max_workers=len(GEMINI_API_KEYS)) as executor:
+        futures = [executor.submit(delete_all_files_for_key, key) for key in GEMINI_API_KEYS]
+        wait(futures, return_when=ALL_COMPLETED)
+
+    failed = sum(1 for f in futures if f.exception())
+    if failed:
+        logging.error(f"❌ {failed}/{len(futures)} 個 key 處理失敗")
 
 
 if __name__ == "__main__":
@@ -10,11 +10,11 @@ Episode Level 處理模組：處理單集動畫的查詢生成
 - 呼叫 Gemini API 進行內容分析
 """
 
-import json
 from typing import Any, Dict
 
 import google.genai as genai
-from google.genai import types
+
+from gemini_common import BadResponseError, build_template, generate_json, parse_json_response
 
 
 # ================== Schema 定義 ==================
@@ -111,6 +111,10 @@ PROMPT = """你會取得「同一集動畫影片」的內容，你的任務是
 """
 
 
+# 固定的提示詞與設定只建一次
+_PROMPT_PART, _CONFIG = build_template(PROMPT, EPISODE_SCHEMA)
+
+
 # ================== Gemini API 呼叫 ==================
 
 def generate_episode_queries(
@@ -129,32 +133,9 @@ def generate_episode_queries(
     Returns:
         包含查詢語句的字典
     """
-    resp = client.models.generate_content(
-        model=model_name,
-        contents=types.Content(
-            parts=[
-                types.Part(
-                    file_data=types.FileData(file_uri=file_uri),
-                    video_metadata=types.VideoMetadata(fps=0.5)
-                ),
-                types.Part(text=PROMPT),
-            ]
-        ),
-        config={
-            "response_mime_type": "application/json",
-            "response_schema": EPISODE_SCHEMA,
-        }
-    )
-    
-    # 嘗試多種方式獲取響應內容
-    if resp.text:
-        return json.loads(resp.text)
-    elif hasattr(resp, 'candidates') and resp.candidates:
-        candidate = resp.candidates[0]
-        if hasattr(candidate, 'content') and candidate.content:
-            if hasattr(candidate.content, 'parts') and candidate.content.parts:
-                text = candidate.content.parts[0].text
-                if text:
-                    return json.loads(text)
-    
-    raise ValueError("Gemini API 返回空響應")
+    resp = generate_json(client, file_uri, _PROMPT_PART, _CONFIG, fps=0.5, model_name=model_name)
+    data = parse_json_response(resp, EPISODE_SCHEMA)
+    if data is not None:
+        return data
+
+    raise BadResponseError("Gemini API 返回空響應")
@@ -0,0 +1,189 @@
+"""
+共用的 Gemini 呼叫模組：三個等級的查詢生成都走這裡
+
+segment / episode / series 三個處理模組只差在 schema、提示詞和抽幀 fps，
+送出請求和解析回應的流程完全相同，所以集中在這裡。
+
+主要功能：
+- 預先建好固定的提示詞 Part 與生成設定
+- 組出「影片 + 提示詞」的請求並要求 JSON 輸出
+- 從回應中取出 JSON 內容，並確認結構符合 schema
+- 回應是空的時候分辨是被擋下來還是單純輸出壞掉
+"""
+
+from typing import Any, Dict, Optional, Tuple
+
+import google.genai as genai
+import orjson
+from google.genai import types
+
+
+class BlockedContentError(Exception):
+    """當內容被 Gemini API 阻止時拋出"""
+    pass
+
+
+class BadResponseError(Exception):
+    """回應內容有問題（空的、不是 JSON、結構不符）；通常是模型這次輸出壞掉，重新請求就好了"""
+    pass
+
+
+def build_template(prompt: str, schema: Dict[str, Any]) -> Tuple[types.Part, types.GenerateContentConfig]:
+    """
+    把固定不變的提示詞 Part 和 config 先建好
+    各處理模組在 import 時呼叫一次，之後每次請求只需要換影片的 Part
+
+    Args:
+        prompt: 提示詞
+        schema: 回應的 JSON schema
+
+    Returns:
+        (提示詞 Part, 生成設定)
+    """
+    return (
+        types.Part(text=prompt),
+        types.GenerateContentConfig(
+            response_mime_type="application/json",
+            response_schema=schema,
+        ),
+    )
+
+
+def video_part(file_uri: Optional[str], video_bytes: Optional[bytes], fps: float) -> types.Part:
+    """影片的 Part：有 bytes 就直接內嵌在請求裡，否則引用已上傳的檔案"""
+    if video_bytes is not None:
+        return types.Part(
+            inline_data=types.Blob(data=video_bytes, mime_type="video/mp4"),
+            video_metadata=types.VideoMetadata(fps=fps),
+        )
+    return types.Part(
+        file_data=types.FileData(file_uri=file_uri),
+        video_metadata=types.VideoMetadata(fps=fps),
+    )
+
+
+def generate_json(
+    client: genai.Client,
+    file_uri: Optional[str],
+    prompt_part: types.Part,
+    config: types.GenerateContentConfig,
+    fps: float,
+    model_name: str,
+    video_bytes: Optional[bytes] = None,
+) -> types.GenerateContentResponse:
+    """
+    對一支影片送出查詢生成請求
+
+    Args:
+        client: Gemini API 客戶端
+        file_uri: 上傳到 Gemini 的檔案 URI（有給 video_bytes 時不用）
+        prompt_part: build_template 建好的提示詞 Part
+        config: build_template 建好的生成設定
+        fps: Gemini 抽幀的 fps
+        model_name: 使用的模型名稱
+        video_bytes: 夠小的影片直接內嵌在請求裡，省掉 Files API 上傳
+
+    Returns:
+        Gemini 的原始回應
+    """
+    return client.models.generate_content(
+        model=model_name,
+        # 固定的提示詞放最前面，同一個模組的請求前綴都一樣，
+        # Gemini 的 implicit context caching 才能重用這段
+        contents=types.Content(
+            parts=[prompt_part, video_part(file_uri, video_bytes, fps)]
+        ),
+        config=config,
+    )
+
+
+def check_schema(data: Any, schema: Dict[str, Any], where: str = "$"):
+    """
+    確認回應有 schema 要求的欄位、型別是 object / array
+    response_schema 不保證每次都遵守，缺欄位的結果寫進 cache 之後很難發現，在這裡就擋下來
+
+    Raises:
+        BadResponseError: 結構不符（模型這次沒照 schema 輸出，重新請求通常就好了）
+    """
+    kind = schema.get("type")
+    if kind == "object":
+        if not isinstance(data, dict):
+            raise BadResponseError(f"{where} 應該是 object")
+        missing = [k for k in schema.get("required", []) if k not in data]
+        if missing:
+            raise BadResponseError(f"{where} 缺少欄位: {', '.join(missing)}")
+        for key, sub in schema.get("properties", {}).items():
+            if key in data:
+                check_schema(data[key], sub, f"{where}.{key}")
+    elif kind == "array":
+        if not isinstance(data, list):
+            raise BadResponseError(f"{where} 應該是 array")
+        for i, item in enumerate(data):
+            check_schema(item, schema.get("items", {}), f"{where}[{i}]")
+
+
+def parse_json_response(
+    resp: types.GenerateContentResponse,
+    schema: Optional[Dict[str, Any]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    嘗試多種方式獲取響應內容
+
+    Args:
+        resp: Gemini 的原始回應
+        schema: 有給的話，順便檢查結構
+
+    Returns:
+        解析後的字典；回應是空的就回 None
+
+    Raises:
+        BadResponseError: JSON 解析不了，或結構不符 schema
+    """
+    text = resp.text
+    if not text and hasattr(resp, 'candidates') and resp.candidates:
+        candidate = resp.candidates[0]
+        if hasattr(candidate, 'content') and candidate.content:
+            if hasattr(candidate.content, 'parts') and candidate.content.parts:
+                text = candidate.content.parts[0].text
+    if not text:
+        return None
+    try:
+        data = orjson.loads(text)
+    except orjson.JSONDecodeError as e:
+        raise BadResponseError(f"回應不是合法的 JSON: {e}") from e
+    if schema is not None:
+        check_schema(data, schema)
+    return data
+
+
+def raise_empty_response(resp: types.GenerateContentResponse):
+    """
+    回應裡沒有內容時呼叫：被安全過濾擋下來就丟 BlockedContentError（重試也一樣），
+    否則丟 BadResponseError（重新請求通常就好了）
+
+    Raises:
+        BlockedContentError: prompt_feedback 有 block_reason
+        BadResponseError: 其他原因的空回應
+    """
+    error_info = []
+    is_blocked = False
+    if hasattr(resp, 'prompt_feedback'):
+        feedback = resp.prompt_feedback
+        if hasattr(feedback, 'block_reason') and feedback.block_reason:
+            is_blocked = True
+            error_info.append(f"block_reason: {feedback.block_reason}")
+        error_info.append(f"prompt_feedback: {resp.prompt_feedback}")
+
+    if hasattr(resp, 'candidates'):
+        if not resp.candidates:
+            error_info.append("candidates 為空")
+        else:
+            for idx, candidate in enumerate(resp.candidates):
+                if hasattr(candidate, 'finish_reason'):
+                    error_info.append(f"candidate {idx} finish_reason: {candidate.finish_reason}")
+                if hasattr(candidate, 'safety_ratings'):
+                    error_info.append(f"candidate {idx} safety_ratings: {candidate.safety_ratings}")
+
+    if is_blocked:
+        raise BlockedContentError("; ".join(error_info))
+    raise BadResponseError("Gemini API 返回空響應: " + "; ".join(error_info))
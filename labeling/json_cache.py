@@ -0,0 +1,38 @@
+"""
+JSON cache 讀寫模組：segment / episode / series 的 cache 檔都走這裡
+
+使用 orjson，序列化和解析都比標準庫 json 快，且直接輸出 UTF-8（中文不會被轉義）。
+cache 只給程式讀，所以寫成不縮排的緊湊格式；比較大的檔案再用 gzip 壓縮。
+寫入是 atomic 的，不會出現壞掉的 cache。
+"""
+
+import os
+import gzip
+from pathlib import Path
+from typing import Any
+
+import orjson
+
+GZIP_THRESHOLD = 4096  # bytes，超過才壓縮
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+def write_json(path: Path, obj: Any):
+    """
+    把物件寫成 JSON cache 檔
+    先寫暫存檔再 os.replace，中途掛掉也不會留下寫一半的 cache
+    """
+    data = orjson.dumps(obj)
+    if len(data) > GZIP_THRESHOLD:
+        data = gzip.compress(data)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def read_json(path: Path) -> Any:
+    """讀回 JSON cache 檔（自動判斷有沒有 gzip，舊的縮排格式也讀得到）"""
+    data = path.read_bytes()
+    if data[:2] == _GZIP_MAGIC:
+        data = gzip.decompress(data)
+    return orjson.loads(data)
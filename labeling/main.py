@@ -1,22 +1,32 @@
 import os
-import json
 import time
+import pickle
+import hashlib
 import logging
 import tempfile
 import shutil
 import subprocess
 import threading
+import itertools
+import uuid
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+# huggingface_hub 1.x 已經拿掉 hf_transfer，改走 hf_xet
+# 高效能模式會開滿並行的 chunk 上傳，要在 import huggingface_hub 之前設定
+os.environ.setdefault("HF_XET_HIGH_PERFORMANCE", "1")
+
 from dotenv import load_dotenv
-from datasets import load_dataset, Video
-from huggingface_hub import HfApi, create_repo
+from datasets import load_dataset
+from huggingface_hub import HfApi, CommitOperationAdd, RepoFile
+import orjson
 import google.genai as genai
-from moviepy import VideoFileClip
+from google.genai import errors as genai_errors
+from tenacity import Retrying, retry_if_exception, wait_exponential_jitter
 
-from segment_processor import generate_segment_queries, BlockedContentError
+from segment_processor import generate_segment_queries, generate_segment_queries_batch, BlockedContentError
 from episode_processor import generate_episode_queries
 from series_processor import generate_series_queries
 from update_metadata import (
@@ -24,6 +34,7 @@ from update_metadata import (
     update_episode_metadata,
     update_series_metadata,
 )
+from json_cache import read_json, write_json
 
 # ========= 基本設定 =========
 load_dotenv()
@@ -36,66 +47,186 @@ if not GEMINI_KEYS:
 if not HF_TOKEN:
     raise RuntimeError("need HF_TOKEN")
 
+HF_API = HfApi(token=HF_TOKEN)  # 整個程式共用一個，不用每次上傳都建新的
+
 HF_SEG = "TakalaWang/anime-2024-winter-segment-queries"
 HF_EP  = "TakalaWang/anime-2024-winter-episode-queries"
 HF_SER = "TakalaWang/anime-2024-winter-series-queries"
 
 CACHE_ROOT = Path("cache_gemini_video"); CACHE_ROOT.mkdir(exist_ok=True)
 VIDEO_ROOT = CACHE_ROOT / "videos"; VIDEO_ROOT.mkdir(exist_ok=True)
+PROXY_ROOT = CACHE_ROOT / "proxies"; PROXY_ROOT.mkdir(exist_ok=True)  # 只給 Gemini 看的低 fps 版本，不上 HF
 ERROR_LOG = CACHE_ROOT / "error_log.jsonl"
+UPLOAD_INDEX = CACHE_ROOT / "gemini_uploads.json"
+FILE_META = CACHE_ROOT / "file_meta.json"  # 本機檔案 -> sha256 / ffprobe 結果，檔案沒變就不用重算
+GEMINI_FILE_TTL = 48 * 3600  # Gemini Files API 的檔案保留時間（秒）
+PROCESSING_TIMEOUT = 900  # 上傳後最多等 Gemini PROCESSING 幾秒
 
 DATASET = "JacobLinCool/anime-2024"
 SUBSET = "winter"
 SEG_LEN = 60
 SEG_OVERLAP = 5
+EPISODE_PROXY_FPS = 1  # 整集 proxy 的 fps，要夠 segment 用（episode-level 只抽 0.5）
+KEY_COOLDOWN = 30  # 吃到 429 的 key 休息幾秒
+MAX_KEY_WAIT = 300  # 同一個請求一直吃 429 時，key 冷卻時間的上限；所有 key 都要等更久就不等了
+DAILY_QUOTA_COOLDOWN = 3600  # 每日額度用完的 key 休息幾秒（額度是整天算的，短時間內再試也沒用）
+# 每把 key 每分鐘最多送幾個產生 query 的請求，照 key 的額度設；0 = 不主動限速，只靠 429 冷卻
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "0"))
+# 請求內嵌影片的上限：整個請求要在 20MB 以內，內容還會被 base64 放大 4/3，留點空間給 prompt
+INLINE_VIDEO_LIMIT = 14 * 1024 * 1024
+SEG_BATCH = 8  # 一個 Gemini 請求處理幾段 segment
+CUT_WORKERS = os.cpu_count() or 4  # 所有 episode 加起來同時在跑幾個切片段的 ffmpeg
+SEG_WORKERS_PER_KEY = 4  # 每把 key 同時在跑的 segment 上傳/產生 query 數
+HF_UPLOAD_THREADS = 16  # 一個 commit 裡同時上傳幾個檔案（huggingface_hub 預設只有 5）
+SERIES_PREP_WORKERS = 2  # 背景同時在準備幾個 series 的影片（接檔吃磁碟 I/O、轉低 fps 吃 CPU）
+UPLOAD_INDEX_FLUSH_INTERVAL = 60  # UPLOAD_INDEX 有新紀錄時，最多隔幾秒寫回磁碟一次（結束時一定會寫）
+FILE_META_FLUSH_INTERVAL = 60  # FILE_META 有新結果時，最多隔幾秒寫回磁碟一次（結束時一定會寫）
+METADATA_FLUSH_INTERVAL = 1800  # 長時間執行時，中途至少每隔幾秒更新一次 HF 上的 metadata.jsonl
 
 # ========= 小工具 =========
 _key_lock = threading.Lock()
-_key_idx = 0
+_key_counter = itertools.count()
+_clients: Dict[str, genai.Client] = {k: genai.Client(api_key=k) for k in GEMINI_KEYS}
+_cooldown_until: Dict[str, float] = {}  # key -> 冷卻結束的時間
+_next_slot: Dict[str, float] = {}  # key -> 下一個請求最早可以送出的時間（GEMINI_RPM 限速用）
+_uri_lock = threading.Lock()
+_uri_cache: Dict[tuple, Dict[str, Any]] = {}  # (本機路徑, mtime_ns, 大小) -> 這次執行已上傳過的 Gemini 檔案（name / uri / expires）
+_upload_index: Optional[Dict[str, Dict[str, Any]]] = None  # 檔案 sha256 -> 上傳紀錄，跨執行共用
+_upload_index_dirty = False  # 有還沒寫回 UPLOAD_INDEX 的紀錄
+_upload_index_saved = time.monotonic()  # 上次寫回 UPLOAD_INDEX 的時間
+_meta_lock = threading.Lock()
+_file_meta: Optional[Dict[str, Dict[str, Any]]] = None  # FILE_META 的內容，第一次用到才讀
+_file_meta_dirty = False  # 有還沒寫回 FILE_META 的結果
+_file_meta_saved = time.monotonic()  # 上次寫回 FILE_META 的時間
+_path_locks: Dict[str, threading.Lock] = {}  # 本機路徑 -> 轉檔/上傳那個檔案時要拿的鎖
+_segment_pool = ThreadPoolExecutor(max_workers=len(GEMINI_KEYS) * SEG_WORKERS_PER_KEY)
+_cut_pool = ThreadPoolExecutor(max_workers=CUT_WORKERS)  # 每個工作是一個 ffmpeg process，thread 只是在等它
+_dirty_lock = threading.Lock()
+_dirty: set = set()  # metadata 要更新的等級：segment / episode / series
+_last_flush = time.monotonic()
 
 def safe_name(s: str) -> str:
     """把 series 名稱變成檔名安全的形式"""
     return s.replace(" ", "_").replace("/", "_").strip()
 
+def _path_lock(path: str) -> threading.Lock:
+    with _uri_lock:
+        return _path_locks.setdefault(path, threading.Lock())
+
+def _next_key() -> str:
+    """
+    輪流拿一把 Gemini key，還在冷卻的 key 先跳過
+    全部都在冷卻的話就照輪到的那把用
+    next(count) 在 GIL 底下是原子操作，不用再拿鎖
+    """
+    now = time.monotonic()
+    for _ in range(len(GEMINI_KEYS)):
+        i = next(_key_counter) % len(GEMINI_KEYS)
+        key = GEMINI_KEYS[i]
+        if _cooldown_until.get(key, 0) <= now:
+            break
+    print(f"🔑 使用 Gemini key #{i}")
+    return key
+
+class KeysExhaustedError(Exception):
+    """所有 key 都還要冷卻超過 MAX_KEY_WAIT 秒（通常是每日額度都用完了）"""
+    pass
+
+def _next_paced_key() -> str:
+    """
+    有設 GEMINI_RPM 時用：挑最快輪到的 key，先預約它的下一個時段，等到了才回傳
+    每把 key 的請求至少間隔 60 / GEMINI_RPM 秒，不用等到吃 429 才知道太快
+    最快的 key 也要冷卻太久的話不預約、不等，直接丟 KeysExhaustedError
+    """
+    with _key_lock:
+        now = time.monotonic()
+        ready_at = {k: max(_next_slot.get(k, 0), _cooldown_until.get(k, 0)) for k in GEMINI_KEYS}
+        key = min(GEMINI_KEYS, key=ready_at.__getitem__)
+        if _cooldown_until.get(key, 0) - now > MAX_KEY_WAIT:
+            raise KeysExhaustedError(f"所有 key 都還要冷卻超過 {MAX_KEY_WAIT}s")
+        slot = max(now, ready_at[key])
+        _next_slot[key] = slot + 60 / GEMINI_RPM
+    if slot > now:
+        time.sleep(slot - now)
+    print(f"🔑 使用 Gemini key #{GEMINI_KEYS.index(key)}")
+    return key
+
+def _client_for(key: str) -> genai.Client:
+    """每把 key 的 client 在啟動時就建好，之後重用，連線池才不會每次重建"""
+    return _clients[key]
+
+def cool_down(key: str, seconds: float = KEY_COOLDOWN):
+    """吃到 429 的 key 先放一邊，seconds 秒內輪不到它"""
+    with _key_lock:
+        _cooldown_until[key] = time.monotonic() + seconds
+
+def _time_until_key_available() -> float:
+    """還要等幾秒才有 key 不在冷卻；現在就有的話回 0"""
+    soonest = min(_cooldown_until.get(k, 0) for k in GEMINI_KEYS)
+    return max(0.0, soonest - time.monotonic())
+
 def make_client() -> genai.Client:
     """
     輪流拿一把 Gemini key
     無論成功或失敗，你每次呼叫這個都會拿到下一把
     """
-    global _key_idx
-    with _key_lock:
-        key = GEMINI_KEYS[_key_idx]
-        _key_idx = (_key_idx + 1) % len(GEMINI_KEYS)
-        print(f"🔑 使用 Gemini key #{_key_idx}")
-    return genai.Client(api_key=key)
+    return _client_for(_next_key())
 
 def log_error(context: str, error: str):
     ERROR_LOG.parent.mkdir(parents=True, exist_ok=True)
-    with ERROR_LOG.open("a", encoding="utf-8") as f:
-        json.dump(
-            {
-                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
-                "context": context,
-                "error": error,
-            },
-            f,
-            ensure_ascii=False,
-        )
-        f.write("\n")
+    line = orjson.dumps({
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "context": context,
+        "error": error,
+    }) + b"\n"
+    # 一次寫完整行，多個 thread 同時寫也不會交錯
+    with ERROR_LOG.open("ab") as f:
+        f.write(line)
 
 # ======== 判斷要不要重試 ========
-def _is_retryable_error(e: Exception) -> bool:
+def _is_quota_error(e: Exception) -> bool:
+    """這把 key 的額度用完了（429），換別把 key 比原地等有用"""
     s = str(e)
-    retry_keys = [
-        "503",  # Service Unavailable
-        "429",  # Too Many Requests
-        "UNAVAILABLE",
-        "DEADLINE_EXCEEDED",
-        "temporarily overloaded",
-    ]
-    return any(k in s for k in retry_keys)
+    return "429" in s or "RESOURCE_EXHAUSTED" in s
+
+def _error_details(e: Exception) -> List[Dict[str, Any]]:
+    """Gemini 錯誤回應裡的 error.details（RetryInfo、QuotaFailure…），沒有就回空的"""
+    body = getattr(e, "details", None)
+    if not isinstance(body, dict):
+        return []
+    body = body.get("error", body)
+    details = body.get("details") if isinstance(body, dict) else None
+    return [d for d in details or [] if isinstance(d, dict)]
+
+def _retry_delay(e: Exception) -> Optional[float]:
+    """429 回應裡 RetryInfo 建議的等待秒數（例如 "59s"），沒附就回 None"""
+    for d in _error_details(e):
+        if d.get("@type", "").endswith("google.rpc.RetryInfo"):
+            try:
+                return float(str(d.get("retryDelay", "")).rstrip("s"))
+            except ValueError:
+                return None
+    return None
+
+def _is_daily_quota(e: Exception) -> bool:
+    """用完的是每日額度（quotaId 帶 PerDay），不是每分鐘的速率限制"""
+    for d in _error_details(e):
+        if d.get("@type", "").endswith("google.rpc.QuotaFailure"):
+            if any("PerDay" in v.get("quotaId", "") for v in d.get("violations", [])):
+                return True
+    return False
+
+# 重試也不會變的錯誤：內容被擋、檔案不存在
+# 回應是空的、不是 JSON、結構不符（BadResponseError）通常只是這次輸出壞掉，要重試
+NON_RETRYABLE = (BlockedContentError, FileNotFoundError, KeysExhaustedError)
 
 def _is_fatal_error(e: Exception) -> bool:
+    if isinstance(e, NON_RETRYABLE):
+        return True
+    # 4xx 是請求本身有問題（參數錯、檔案不存在、太大…），換 key 也一樣
+    # 只有 429（額度）和 408（逾時）再試才有意義
+    if isinstance(e, genai_errors.ClientError) and e.code not in (408, 429):
+        return True
     s = str(e)
     fatal_keys = [
         "PERMISSION_DENIED",  # 403，被停用
@@ -106,77 +237,496 @@ def _is_fatal_error(e: Exception) -> bool:
     return any(k in s for k in fatal_keys)
 
 # ======== 通用重試器：每一輪都換 key ========
-def retry(fn_factory, ctx: str, times: int = 5):
+_backoff = wait_exponential_jitter(initial=2, max=60)
+
+def retry(fn_factory, ctx: str, times: int = 5, paced: bool = True):
     """
     fn_factory: 一個接收 client 的函式，例如 lambda c: c.files.upload(...)
     每次重試都會重新建一個使用下一把 key 的 client
     成功、失敗都會「消耗」掉一把 key，達到平均分配
+    等待時間是指數成長加上 jitter，避免所有 worker 同時重試
+    429 的話只把那把 key 冷卻起來，馬上換別把 key 重試，不在 worker 上乾等
+    冷卻多久照 Gemini 回的 retryDelay；每日額度用完的 key 休息更久，所有 key 都要等太久就直接放棄
+    paced: 要不要照 GEMINI_RPM 限速（上傳檔案不算在模型的 RPM 裡）
     """
-    last = None
-    for i in range(times):
-        client = make_client()  # 這裡是關鍵：每一輪都換 client/換 key
+    attempts = 0
+
+    def _attempt():
+        nonlocal attempts
+        attempts += 1
+        # 這裡是關鍵：每一輪都換 client/換 key
+        if paced and GEMINI_RPM > 0:
+            key = _next_paced_key()
+        else:
+            if paced and _time_until_key_available() > MAX_KEY_WAIT:
+                # 每日額度都用完了：送出去也只會再吃一次 429
+                raise KeysExhaustedError(f"所有 key 都還要冷卻超過 {MAX_KEY_WAIT}s")
+            key = _next_key()
         try:
-            return fn_factory(client)
+            return fn_factory(_client_for(key))
         except Exception as e:
-            last = e
+            if _is_daily_quota(e):
+                cool_down(key, DAILY_QUOTA_COOLDOWN)
+            elif _is_quota_error(e):
+                # 有附 retryDelay 就照它等（多留 1 秒）；沒附的話同一個請求一直吃 429，冷卻時間就越拉越長
+                delay = _retry_delay(e)
+                if delay is not None:
+                    cool_down(key, delay + 1)
+                else:
+                    cool_down(key, min(KEY_COOLDOWN * 2 ** (attempts - 1), MAX_KEY_WAIT))
+            raise
 
-            if _is_fatal_error(e):
-                logging.error(f"{ctx} fatal error: {e}")
-                break
+    def _wait(rs) -> float:
+        if _is_quota_error(rs.outcome.exception()):
+            # 還有別的 key 能用就不等；全部都在冷卻才等到最早的那把
+            return _time_until_key_available()
+        # 其他錯誤（例如 503）有附 retryDelay 也照它等
+        delay = _retry_delay(rs.outcome.exception())
+        return delay + 1 if delay is not None else _backoff(rs)
 
-            if _is_retryable_error(e):
-                # 第一次炸得很正常，給短一點
-                wait = 2 if i == 0 else min(3 * (2 ** i), 10)
-            else:
-                wait = 5
+    def _stop(rs) -> bool:
+        if rs.attempt_number >= times:
+            return True
+        # 每把 key 的每日額度都用完了：等下去只是讓 worker 卡住，這次先放棄，下次執行再補
+        return _is_quota_error(rs.outcome.exception()) and _time_until_key_available() > MAX_KEY_WAIT
 
-            logging.warning(f"{ctx} 第 {i+1} 次失敗，{wait}s 後換下一把 key 再試：{e}")
-            time.sleep(wait)
+    def _before_sleep(rs):
+        logging.warning(
+            f"{ctx} 第 {rs.attempt_number} 次失敗，{rs.next_action.sleep:.1f}s 後換下一把 key 再試："
+            f"{rs.outcome.exception()}"
+        )
 
-    log_error(ctx, str(last))
-    return None
+    retrying = Retrying(
+        stop=_stop,
+        wait=_wait,
+        retry=retry_if_exception(lambda e: not _is_fatal_error(e)),
+        before_sleep=_before_sleep,
+        reraise=True,
+    )
+    try:
+        return retrying(_attempt)
+    except Exception as e:
+        if _is_fatal_error(e):
+            logging.error(f"{ctx} fatal error: {e}")
+        log_error(ctx, str(e))
+        return None
 
 # ======== 上傳 ========
-def upload_file_to_gemini(path: str) -> Optional[str]:
+def submit_upload(path: str):
     """
-    上傳檔案到 Gemini
+    只負責把檔案送上 Gemini，不等處理完成
     上傳本身也透過 retry，所以每次成功/失敗都會輪 key
     """
     p = Path(path)
     try:
         p.name.encode("ascii")
-        up = str(p)
     except UnicodeEncodeError:
-        tmp = Path(tempfile.gettempdir()) / f"tmp_{int(time.time()*1000)}{p.suffix}"
-        shutil.copy2(p, tmp)
-        up = str(tmp)
+        # 檔名有中文上傳會炸，給它一個 ASCII 的別名
+        tmp = _ascii_alias(p)
+        try:
+            return retry(lambda c: c.files.upload(file=str(tmp)), f"upload {path}", paced=False)
+        finally:
+            tmp.unlink(missing_ok=True)
 
     # 用 retry，讓它自己換 client
-    obj = retry(lambda c: c.files.upload(file=up), f"upload {path}")
-    if not obj:
-        return None
+    return retry(lambda c: c.files.upload(file=str(p)), f"upload {path}", paced=False)
+
+def _ascii_alias(p: Path) -> Path:
+    """
+    在暫存資料夾做一個 ASCII 檔名指向同一個檔案
+    優先 hardlink / symlink（不用真的複製幾百 MB），都不行才 copy
+    """
+    tmp = Path(tempfile.gettempdir()) / f"tmp_{uuid.uuid4().hex}{p.suffix}"
+    try:
+        os.link(p, tmp)
+    except OSError:
+        try:
+            os.symlink(p.absolute(), tmp)
+        except OSError:
+            shutil.copy2(p, tmp)
+    return tmp
 
+def wait_active(obj, path: str) -> Optional[str]:
+    """等 Gemini 把檔案處理完，回傳 uri；FAILED 回 None"""
     # 等待處理完成：這裡也可以換 client 來 get
+    # 小檔通常很快就好，先密一點問，之後慢慢拉長，最多 10 秒問一次
+    delay = 0.5
+    deadline = time.monotonic() + PROCESSING_TIMEOUT
     while obj.state.name == "PROCESSING":
-        time.sleep(5)
+        if time.monotonic() > deadline:
+            # 卡住的檔案不要讓 worker 無限等下去
+            log_error(f"gemini processing {path}", f"still PROCESSING after {PROCESSING_TIMEOUT}s")
+            return None
+        time.sleep(delay)
+        delay = min(delay * 1.5, 10)
         client = make_client()
         obj = client.files.get(name=obj.name)
 
     if obj.state.name == "FAILED":
         log_error(f"gemini processing {path}", "state=FAILED")
         return None
-
     return obj.uri
 
+def file_meta(path: str, field: str, compute):
+    """
+    以 (mtime, 大小) 判斷檔案沒變，就直接用存在 FILE_META 的結果，跨執行也有效
+    hash 整支影片、跑 ffprobe 這類只跟檔案內容有關的東西都走這裡
+    新結果先放在記憶體，每 FILE_META_FLUSH_INTERVAL 秒才整份寫回一次，不然檔案一多每算一個就要重寫整份
+    """
+    st = os.stat(path)
+    sig = [st.st_mtime_ns, st.st_size]
+    global _file_meta, _file_meta_dirty
+    with _meta_lock:
+        if _file_meta is None:
+            _file_meta = read_json(FILE_META) if FILE_META.exists() else {}
+        entry = _file_meta.get(path)
+        if entry and entry["sig"] == sig and field in entry:
+            return entry[field]
+
+    value = compute()
+    with _meta_lock:
+        entry = _file_meta.get(path)
+        if not entry or entry["sig"] != sig:
+            entry = _file_meta[path] = {"sig": sig}
+        entry[field] = value
+        _file_meta_dirty = True
+    flush_file_meta(force=False)
+    return value
+
+def flush_file_meta(force: bool = True):
+    """把還沒寫回的 FILE_META 結果寫到磁碟；force=False 時離上次寫回不到 FILE_META_FLUSH_INTERVAL 秒就先不寫"""
+    global _file_meta_dirty, _file_meta_saved
+    with _meta_lock:
+        if not _file_meta_dirty:
+            return
+        if not force and time.monotonic() - _file_meta_saved < FILE_META_FLUSH_INTERVAL:
+            return
+        write_json(FILE_META, _file_meta)
+        _file_meta_dirty = False
+        _file_meta_saved = time.monotonic()
+
+def _file_hash(path: str) -> str:
+    def _sha256():
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+    return file_meta(path, "sha256", _sha256)
+
+def _load_upload_index() -> Dict[str, Dict[str, Any]]:
+    """呼叫端要先拿 _uri_lock"""
+    global _upload_index
+    if _upload_index is None:
+        _upload_index = read_json(UPLOAD_INDEX) if UPLOAD_INDEX.exists() else {}
+    return _upload_index
+
+def flush_upload_index(force: bool = True):
+    """
+    把新的上傳紀錄寫回 UPLOAD_INDEX，順便丟掉已經過期的（Gemini 那邊 48 小時後就刪了）
+    force=False 時離上次寫回不到 UPLOAD_INDEX_FLUSH_INTERVAL 秒就先不寫
+    """
+    global _upload_index, _upload_index_dirty, _upload_index_saved
+    with _uri_lock:
+        if not _upload_index_dirty:
+            return
+        if not force and time.monotonic() - _upload_index_saved < UPLOAD_INDEX_FLUSH_INTERVAL:
+            return
+        now = time.time()
+        _upload_index = {k: e for k, e in _upload_index.items() if e["expires"] > now}
+        write_json(UPLOAD_INDEX, _upload_index)
+        _upload_index_dirty = False
+        _upload_index_saved = time.monotonic()
+
+def _still_valid(entry: Optional[Dict[str, Any]]) -> bool:
+    """上傳紀錄還沒過期（留 5 分鐘緩衝，不要用到一半被刪）"""
+    return bool(entry) and entry["expires"] > time.time() + 300
+
+def _reuse_uploaded(digest: str) -> Optional[Dict[str, Any]]:
+    """之前的執行上傳過同樣內容、還沒過期、Gemini 那邊也還是 ACTIVE，就直接用"""
+    with _uri_lock:
+        entry = _load_upload_index().get(digest)
+    if not _still_valid(entry):
+        return None
+    try:
+        obj = make_client().files.get(name=entry["name"])
+    except Exception:
+        return None
+    return entry if obj.state.name == "ACTIVE" else None
+
+def upload_file_to_gemini(path: str) -> Optional[str]:
+    """
+    上傳檔案到 Gemini 並等到可以用
+    同一次執行裡同一個檔案只會上傳一次（執行超過 48 小時，過期的會重傳）
+    跨執行用內容 hash 記住上傳過的檔案，48 小時內不重傳
+    新紀錄先放在記憶體，由 flush_upload_index 定期和結束時寫回
+    """
+    global _upload_index_dirty
+    # 連 mtime / 大小一起當 key：proxy 重轉之後路徑一樣，但不能再用舊的上傳
+    st = os.stat(path)
+    cache_key = (path, st.st_mtime_ns, st.st_size)
+    with _uri_lock:
+        entry = _uri_cache.get(cache_key)
+    if _still_valid(entry):
+        return entry["uri"]
+
+    digest = _file_hash(path)
+    entry = _reuse_uploaded(digest)
+    if entry:
+        with _uri_lock:
+            _uri_cache[cache_key] = entry
+        return entry["uri"]
+
+    obj = submit_upload(path)
+    if not obj:
+        return None
+
+    uri = wait_active(obj, path)
+    if uri:
+        entry = {"name": obj.name, "uri": uri, "expires": time.time() + GEMINI_FILE_TTL}
+        with _uri_lock:
+            _uri_cache[cache_key] = entry
+            _load_upload_index()[digest] = entry
+            _upload_index_dirty = True
+        flush_upload_index(force=False)
+    return uri
+
+# 轉 proxy 用的 encoder，依序試硬體 encoder，都不能用就退回 libx264
+_PROXY_ENCODERS = [
+    # nvenc 的 -cq 要配 -rc vbr -b:v 0 才是真的固定品質，不然會被預設 bitrate 綁住
+    ["-c:v","h264_nvenc","-preset","p1","-rc","vbr","-cq","35","-b:v","0"],
+    ["-c:v","h264_qsv","-preset","veryfast","-global_quality","35"],
+    ["-c:v","libx264","-preset","ultrafast","-crf","35"],
+]
+
+@lru_cache(maxsize=None)
+def proxy_encoder_args() -> tuple:
+    """
+    找出這台機器上能用的 encoder
+    ffmpeg -encoders 有列出來不代表真的有 GPU，所以實際編一格試試看
+    """
+    for args in _PROXY_ENCODERS[:-1]:
+        r = subprocess.run(
+            ["ffmpeg","-hide_banner","-loglevel","error",
+             "-f","lavfi","-i","color=size=256x256:rate=1","-frames:v","1",
+             *args,"-f","null","-"],
+            capture_output=True,
+        )
+        if r.returncode == 0:
+            logging.info(f"🎞️ proxy encoder: {args[1]}")
+            return tuple(args)
+    return tuple(_PROXY_ENCODERS[-1])
+
+def down_video_fps(src: Path, dst: Path, fps: float, keep_audio: bool = False):
+    """
+    轉成低 fps 的小檔，只拿來給 Gemini 看（Gemini 本來就只抽 fps 張），畫質不重要
+    先寫到暫存檔再改名：proxy 新不新是看 mtime，轉到一半中斷的檔案會比來源新，直接寫會被當成轉好了
+    """
+    audio = ["-c:a","aac","-b:a","64k"] if keep_audio else ["-an"]
+    tmp = dst.with_name(dst.stem + ".part.mp4")
+    subprocess.run([
+        "ffmpeg","-y","-hwaccel","auto","-i",str(src),
+        "-vf",f"fps={fps}",*audio,*proxy_encoder_args(),
+        str(tmp)
+    ], check=True)
+    tmp.replace(dst)
+
 # ========= episode 裡面用的 =========
+def _ffprobe(video_path: str) -> Dict[str, Any]:
+    """一個檔案只跑一次 ffprobe，長度和各軌的編碼參數一起拿"""
+    out = subprocess.check_output([
+        "ffprobe","-v","error",
+        "-show_entries","format=duration:stream=codec_type,codec_name,width,height,pix_fmt,avg_frame_rate,r_frame_rate,sample_rate,channels,duration"
+        ":stream_disposition=attached_pic",
+        "-of","json",
+        video_path
+    ])
+    return orjson.loads(out)
+
+def probe(video_path: str) -> Dict[str, Any]:
+    # proxy 之類會被重做的檔案，內容變了 file_meta 就會重新跑
+    # _ffprobe 多拿了欄位（frame rate）就換欄位名稱，舊的 cache 結果不會被拿來用
+    return file_meta(video_path, "ffprobe_v2", lambda: _ffprobe(video_path))
+
+def _first_stream(info: Dict[str, Any], codec_type: str) -> Optional[Dict[str, Any]]:
+    """第一條影像/聲音軌；封面圖也算 video 軌，要跳過"""
+    for st in info.get("streams", []):
+        if st.get("codec_type") == codec_type and not st.get("disposition", {}).get("attached_pic"):
+            return st
+    return None
+
+def probe_duration(video_path: str) -> float:
+    """
+    用 ffprobe 只讀 container header 拿長度，不用整個打開解碼器
+    有些檔案 container 沒寫 duration（N/A），就退回用影像軌的長度
+    """
+    info = probe(video_path)
+    video = _first_stream(info, "video") or {}
+    for dur in (info.get("format", {}).get("duration"), video.get("duration")):
+        if dur not in (None, "N/A"):
+            return float(dur)
+    raise ValueError(f"ffprobe 讀不到長度: {video_path}")
+
+def probe_streams(video_path: str) -> tuple:
+    """影像/聲音軌的編碼參數，concat 用來判斷能不能直接 stream copy"""
+    info = probe(video_path)
+    video = _first_stream(info, "video") or {}
+    audio = _first_stream(info, "audio") or {}
+    return (
+        tuple(video.get(k) for k in ("codec_name", "width", "height", "pix_fmt")),
+        tuple(audio.get(k) for k in ("codec_name", "sample_rate", "channels")),
+    )
+
+def cut_segment(video_path: str, start: float, end: float, out: Path):
+    """
+    用 ffmpeg stream copy 切出 [start, end) 這段，不重新解碼/編碼
+    -ss 放在 -i 前面是 input seek，只會讀需要的那段
+    -t 也放在 -i 前面（讀到 end 為止），stream copy 會從 start 前一個 keyframe 開始，片段實際是 [keyframe, end)
+    先寫到暫存檔再改名，中斷時不會留下切一半的檔案被當成 cache
+    stream copy 失敗（例如來源的編碼放不進 mp4）才退回重新編碼
+    """
+    tmp = out.with_name(out.stem + ".part.mp4")
+    cmd = [
+        "ffmpeg","-y","-loglevel","error",
+        "-ss",str(start),"-t",str(end - start),"-i",video_path,
+        # 只留影像和聲音，字幕/資料軌放進 mp4 會失敗
+        "-map","0:v:0","-map","0:a?",
+    ]
+    tail = ["-avoid_negative_ts","make_zero","-movflags","+faststart",str(tmp)]
+    try:
+        subprocess.run([*cmd,"-c","copy",*tail], check=True)
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"⚠️ {out.name} stream copy 失敗，改成重新編碼：{e}")
+        subprocess.run([*cmd,"-c:v","libx264","-preset","ultrafast","-crf","23","-c:a","aac",*tail], check=True)
+    tmp.replace(out)
+
+def cut_segments(video_path: str, cuts: List[tuple]):
+    """
+    同一集要切的片段用一個 ffmpeg 一次切完，省掉每段各開一個 process、各讀一次 header
+    片段之間有 overlap，-f segment 只能切成首尾相接的段，所以改成同一個檔案開成多個 input，
+    每個 input 各自 -ss/-t（跟 cut_segment 一樣是 input seek），各 map 到自己的 output
+    cuts 裡每一項是 (start, end, out)；stream copy 失敗就退回 cut_segment 一段一段切（會重新編碼）
+    """
+    if len(cuts) == 1:
+        cut_segment(video_path, *cuts[0])
+        return
+
+    inputs, outputs, tmps = [], [], []
+    for i, (start, end, out) in enumerate(cuts):
+        tmp = out.with_name(out.stem + ".part.mp4")
+        inputs += ["-ss",str(start),"-t",str(end - start),"-i",video_path]
+        outputs += [
+            "-map",f"{i}:v:0","-map",f"{i}:a?","-c","copy",
+            "-avoid_negative_ts","make_zero","-movflags","+faststart",str(tmp),
+        ]
+        tmps.append((tmp, out))
+    try:
+        subprocess.run(["ffmpeg","-y","-loglevel","error",*inputs,*outputs], check=True)
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"⚠️ {Path(video_path).name} 一次切 {len(cuts)} 段失敗，改成一段一段切：{e}")
+        for start, end, out in cuts:
+            cut_segment(video_path, start, end, out)
+        return
+    for tmp, out in tmps:
+        tmp.replace(out)
+
+def cut_start(seg_mp4: Path, end: float) -> float:
+    """
+    切好的片段在整集裡實際從第幾秒開始
+    stream copy 會從 start 前一個 keyframe 開始切、結束點不變，所以用 end 減掉片段長度回推
+    """
+    return max(0.0, end - probe_duration(str(seg_mp4)))
+
+def _write_segment(series: str, ep: str, idx: int, seg_json: Path, hf_path: str, date: Any, q: Dict[str, Any]):
+    write_json(seg_json, {
+        "series_name": series,
+        "episode_id": ep,
+        "segment_index": idx,
+        "release_date": date,
+        "file_name": hf_path,
+        "query": q,
+    })
+
+def label_segment(series: str, ep: str, idx: int, seg_mp4: Path, seg_json: Path, hf_path: str, date: Any):
+    """
+    一段 segment 交給 Gemini 產生 query，寫進 seg_json
+    夠小的片段直接內嵌在請求裡，不用先上傳再等 PROCESSING
+    """
+    if seg_mp4.stat().st_size <= INLINE_VIDEO_LIMIT:
+        video_bytes = seg_mp4.read_bytes()
+
+        def _call_segment(c):
+            return generate_segment_queries(client=c, video_bytes=video_bytes)
+    else:
+        file_uri = upload_file_to_gemini(str(seg_mp4))
+        if not file_uri:
+            log_error(f"segment upload {series} {ep} seg{idx}", "upload to gemini failed")
+            return
+
+        def _call_segment(c):
+            return generate_segment_queries(client=c, file_uri=file_uri)
+
+    # 這裡也用 retry，每一段都會平均使用不同 key
+    q = retry(_call_segment, f"segment gen {series} {ep} seg{idx}")
+    if q is not None:
+        _write_segment(series, ep, idx, seg_json, hf_path, date, q)
+
+def label_segment_batch(series: str, ep: str, file_uri: str, batch: List[tuple], date: Any) -> bool:
+    """
+    同一集的好幾段用一個請求產生 query（影片是整集，用 offset 指定區間）
+    batch 裡每一項是 (idx, start, end, seg_mp4, seg_json, hf_path)
+    整批失敗回 False，由呼叫端等片段切好再一段一段做
+    """
+    windows = [(start, end) for _, start, end, _, _, _ in batch]
+
+    def _call_batch(c):
+        return generate_segment_queries_batch(client=c, file_uri=file_uri, windows=windows)
+
+    qs = retry(_call_batch, f"segment batch gen {series} {ep} seg{batch[0][0]}-{batch[-1][0]}")
+    if qs is None:
+        return False
+
+    for (idx, _, _, _, seg_json, hf_path), q in zip(batch, qs):
+        _write_segment(series, ep, idx, seg_json, hf_path, date, q)
+    return True
+
+def proxy_complete(proxy: Path, video_path: str) -> bool:
+    """
+    proxy 長度跟原檔差不多才算轉完
+    down_video_fps 現在是寫完才改名，但舊版直接寫目標檔，中斷時會留下 mtime 比原檔新的半截檔案
+    （通常連 moov 都沒有，ffprobe 會直接失敗）
+    """
+    try:
+        return abs(probe_duration(str(proxy)) - probe_duration(video_path)) <= 5
+    except (subprocess.CalledProcessError, ValueError):
+        return False
+
+def episode_file_uri(series: str, ep: str, video_path: str) -> Optional[str]:
+    """
+    整集轉成 1 fps 的 proxy 傳上 Gemini，episode-level（fps=0.5）和 segment batch（fps=1）共用這一份
+    Gemini 本來就只抽這麼多張，原檔只上 HF；台詞也算在 query 裡，所以聲音要留著
+    兩邊會同時來要，用同一把鎖，確保只轉一次、只傳一次
+    """
+    s = safe_name(series)
+    proxy = PROXY_ROOT / s / f"episode_{s}_{ep}_proxy.mp4"
+    with _path_lock(str(proxy)):
+        if is_stale(proxy, [Path(video_path)]) or not proxy_complete(proxy, video_path):
+            proxy.parent.mkdir(parents=True, exist_ok=True)
+            down_video_fps(Path(video_path), proxy, fps=EPISODE_PROXY_FPS, keep_audio=True)
+        return upload_file_to_gemini(str(proxy))
+
 def process_segments(series: str, ep: str, video_path: str, date: Any):
     s = safe_name(series)
     series_dir = VIDEO_ROOT / s
     series_dir.mkdir(parents=True, exist_ok=True)
 
-    with VideoFileClip(video_path) as v:
-        dur = v.duration
+    dur = probe_duration(video_path)
 
+    # 1) 挑出還沒切、還沒有 query 的片段
+    # 資料夾只列一次，之後查 set，不用每段都 stat 兩次
+    existing = {e.name for e in os.scandir(series_dir)}
+    cuts = []
+    jobs = []
     start = 0
     idx = 0
     while start < dur - 5:
@@ -185,38 +735,56 @@ def process_segments(series: str, ep: str, video_path: str, date: Any):
         seg_json = series_dir / f"segment_{s}_{ep}_seg{idx}.json"
         hf_path  = f"videos/{s}/segment_{s}_{ep}_seg{idx}.mp4"
 
-        if not seg_mp4.exists():
-            with VideoFileClip(video_path) as v:
-                v.subclipped(start, end).write_videofile(
-                    str(seg_mp4),
-                    codec="libx264",
-                    audio_codec="aac",
-                    logger=None,
-                )
-
-        if not seg_json.exists():
-            file_uri = upload_file_to_gemini(str(seg_mp4))
-            if not file_uri:
-                log_error(f"segment upload {series} {ep} seg{idx}", "upload to gemini failed")
-            else:
-                # 這裡也用 retry，每一段都會平均使用不同 key
-                def _call_segment(c):
-                    return generate_segment_queries(client=c, file_uri=file_uri)
-
-                q = retry(_call_segment, f"segment gen {series} {ep} seg{idx}")
-                if q is not None:
-                    seg_json.write_text(json.dumps({
-                        "series_name": series,
-                        "episode_id": ep,
-                        "segment_index": idx,
-                        "release_date": date,
-                        "file_name": hf_path,
-                        "query": q,
-                    }, ensure_ascii=False, indent=2), encoding="utf-8")
+        if seg_mp4.name not in existing:
+            cuts.append((start, end, seg_mp4))
+
+        if seg_json.name not in existing:
+            jobs.append((idx, start, end, seg_mp4, seg_json, hf_path))
 
         start += SEG_LEN - SEG_OVERLAP
         idx += 1
 
+    # 2) 這集缺的片段用一個 ffmpeg 切完，丟到所有 episode 共用的 pool，跟整集 proxy 的轉檔、上傳 Gemini 重疊
+    # batch 產生 query 看的是整集的 proxy，但區間要照切好的片段實際的範圍
+    cut_futures = [_cut_pool.submit(cut_segments, video_path, cuts)] if cuts else []
+    if not jobs:
+        for fut in as_completed(cut_futures):
+            fut.result()
+        return
+
+    # 3) 整集傳一次（跟 episode-level 共用同一份 proxy），每 SEG_BATCH 段用一個請求產生 query
+    # 丟進所有 episode 共用的 pool，並行度只跟 key 數有關，不會因為同時在跑幾集而放大
+    file_uri = episode_file_uri(series, ep, video_path)
+
+    # 片段切好才知道實際涵蓋的區間，batch 要看跟上傳 HF 的片段一樣的區間，query 才對得上
+    # stream copy 很快，通常在 proxy 轉檔、上傳完之前就切好了
+    for fut in as_completed(cut_futures):
+        fut.result()
+    jobs = [
+        (idx, cut_start(seg_mp4, end), end, seg_mp4, seg_json, hf_path)
+        for idx, _, end, seg_mp4, seg_json, hf_path in jobs
+    ]
+
+    if file_uri:
+        batches = [jobs[i:i + SEG_BATCH] for i in range(0, len(jobs), SEG_BATCH)]
+        batch_futures = [
+            _segment_pool.submit(label_segment_batch, series, ep, file_uri, batch, date)
+            for batch in batches
+        ]
+        # 整批失敗（例如其中一段被擋）的才退回一段一段做，不要連累其他段
+        fallback = [job for batch, fut in zip(batches, batch_futures) if not fut.result() for job in batch]
+    else:
+        # 整集傳不上去就全部退回一段一段傳
+        log_error(f"episode upload for segments {series} {ep}", "upload to gemini failed")
+        fallback = jobs
+
+    futures = [
+        _segment_pool.submit(label_segment, series, ep, idx, seg_mp4, seg_json, hf_path, date)
+        for idx, _, _, seg_mp4, seg_json, hf_path in fallback
+    ]
+    for fut in as_completed(futures):
+        fut.result()
+
 def process_episode(series: str, ep: str, video_path: str, date: Any):
     s = safe_name(series)
     series_dir = VIDEO_ROOT / s
@@ -230,7 +798,7 @@ def process_episode(series: str, ep: str, video_path: str, date: Any):
         shutil.copy2(video_path, ep_mp4)
 
     if not ep_json.exists():
-        file_uri = upload_file_to_gemini(str(ep_mp4))
+        file_uri = episode_file_uri(series, ep, video_path)
         if not file_uri:
             log_error(f"episode upload {series} {ep}", "upload to gemini failed")
         else:
@@ -239,139 +807,411 @@ def process_episode(series: str, ep: str, video_path: str, date: Any):
 
             q = retry(_call_episode, f"episode {series} {ep}")
             if q is not None:
-                ep_json.write_text(json.dumps({
+                write_json(ep_json, {
                     "file_name": hf_path,
                     "series_name": series,
                     "episode_id": ep,
                     "release_date": date,
                     "query": q,
-                }, ensure_ascii=False, indent=2), encoding="utf-8")
+                })
 
 def run_one_episode(series: str, ep_info: Dict[str, Any]):
     ep_id = ep_info["episode_id"]
     video = ep_info["video_path"]
     date  = ep_info.get("release_date")
-    process_segments(series, ep_id, video, date)
-    process_episode(series, ep_id, video, date)
+    # episode-level 丟到旁邊先跑，它去轉 proxy、上傳、等 Gemini 處理的時候，這邊在切 segment
+    # proxy 兩邊共用，episode_file_uri 會確保只做一次
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        ep_fut = executor.submit(process_episode, series, ep_id, video, date)
+        process_segments(series, ep_id, video, date)
+        ep_fut.result()
 
 # ========= series 上傳 =========
-def upload_one_series(series: str):
-    api = HfApi(token=HF_TOKEN)
-    s = safe_name(series)
+def _video_files(series_dir: Path, prefix: str) -> List[Tuple[str, Path]]:
+    """series_dir 底下 prefix 開頭的 mp4，配上它在 HF repo 裡的路徑"""
+    # 不用 glob：series 名稱裡可能有 [] 之類的萬用字元
+    return [
+        (f"videos/{series_dir.name}/{p.name}", p)
+        for p in sorted(series_dir.iterdir())
+        if p.name.startswith(prefix) and p.suffix == ".mp4" and not p.name.endswith(".part.mp4")
+    ]
 
-    api.upload_large_folder(
-        folder_path=str(CACHE_ROOT),
-        repo_id=HF_SEG,
-        repo_type="dataset",
-        allow_patterns=[f"videos/{s}/segment_{s}_*.mp4"],
-        commit_message=f"{series} segments batch",
-    )
+@lru_cache(maxsize=None)
+def remote_files(repo_id: str) -> Dict[str, Tuple[int, Optional[str]]]:
+    """repo 裡已經有的檔案 -> (大小, LFS 的 sha256)，整次執行只列一次"""
+    tree = HF_API.list_repo_tree(repo_id, repo_type="dataset", recursive=True)
+    return {
+        f.path: (f.size, f.lfs.sha256 if f.lfs else None)
+        for f in tree if isinstance(f, RepoFile)
+    }
+
+def _same_as_remote(remote: Optional[Tuple[int, Optional[str]]], local: Path) -> bool:
+    if remote is None:
+        return False
+    size, sha256 = remote
+    if size != local.stat().st_size:
+        return False
+    # 影片都是 LFS，有 sha256 可以比；hash 存在 FILE_META，沒變的檔案不會再讀一次
+    return sha256 is None or sha256 == _file_hash(str(local))
 
-    api.upload_large_folder(
-        folder_path=str(CACHE_ROOT),
-        repo_id=HF_EP,
+def commit_files(repo_id: str, files: List[Tuple[str, Path]], message: str):
+    """
+    一批檔案放在同一個 commit 裡上傳
+    之前的執行已經傳上去、內容也一樣的檔案跳過
+    CommitOperationAdd 一建立就會 hash 整個檔案，所以先篩掉再建，重跑時不用把整個 series 再讀一次
+    內容不一樣（例如片段重切過）就照樣上傳蓋掉
+    """
+    existing = remote_files(repo_id)
+    ops = [
+        CommitOperationAdd(path_in_repo=path_in_repo, path_or_fileobj=str(local))
+        for path_in_repo, local in files
+        if not _same_as_remote(existing.get(path_in_repo), local)
+    ]
+    if not ops:
+        return
+    HF_API.create_commit(
+        repo_id=repo_id,
         repo_type="dataset",
-        allow_patterns=[f"videos/{s}/episode_{s}_*.mp4"],
-        commit_message=f"{series} episodes batch",
+        operations=ops,
+        commit_message=f"{message} ({len(ops)} files)",
+        num_threads=HF_UPLOAD_THREADS,
     )
 
-    update_segment_metadata(HF_TOKEN)
-    update_episode_metadata(HF_TOKEN)
-    logging.info(f"✅ uploaded whole series {series}")
+def mark_dirty(level: str):
+    """記下這個等級的 metadata 要更新，之後 flush_metadata 一次處理"""
+    with _dirty_lock:
+        _dirty.add(level)
 
-# ========= series-level =========
-def process_series(series: str, eps: List[Dict[str, Any]]):
+def flush_metadata():
+    """每個有變動的等級只重建、上傳一次 metadata.jsonl"""
+    global _last_flush
+    with _dirty_lock:
+        _last_flush = time.monotonic()
+        levels = set(_dirty)
+        _dirty.clear()
+    updaters = {
+        "segment": update_segment_metadata,
+        "episode": update_episode_metadata,
+        "series": update_series_metadata,
+    }
+    # 三個等級是不同的 repo，掃本機 cache、上傳可以一起做
+    with ThreadPoolExecutor(max_workers=len(updaters)) as executor:
+        futures = {executor.submit(updaters[level], HF_TOKEN): level for level in levels}
+        for fut in as_completed(futures):
+            level = futures[fut]
+            try:
+                fut.result()
+            except Exception as e:
+                # 沒傳成功就留著，下次 flush 再試
+                logging.error(f"{level} metadata update failed: {e}")
+                log_error(f"metadata {level}", str(e))
+                mark_dirty(level)
+
+def upload_one_series(series: str):
     s = safe_name(series)
     series_dir = VIDEO_ROOT / s
-    series_dir.mkdir(parents=True, exist_ok=True)
 
-    series_json = series_dir / f"series_{s}.json"
-    if series_json.exists():
+    commit_files(HF_SEG, _video_files(series_dir, f"segment_{s}_"), f"{series} segments batch")
+    mark_dirty("segment")
+
+    commit_files(HF_EP, _video_files(series_dir, f"episode_{s}_"), f"{series} episodes batch")
+    mark_dirty("episode")
+
+    logging.info(f"✅ uploaded whole series {series}")
+
+# ========= series-level =========
+def is_stale(target: Path, sources: List[Path]) -> bool:
+    """target 不存在，或有任何來源比它新，就要重做"""
+    if not target.exists():
+        return True
+    t = target.stat().st_mtime
+    return any(p.stat().st_mtime > t for p in sources)
+
+def concat_videos(paths: List[Path], out: Path):
+    """
+    用 ffmpeg concat demuxer 直接 stream copy 接起來，不重新編碼
+    各集編碼參數不一樣的話 stream copy 接出來會壞掉，只有這時候才重新編碼
+    先寫到暫存檔再改名，中斷時不會留下接一半、mtime 又比來源新的檔案被當成做好了
+    """
+    tmp = out.with_name(out.stem + ".part.mp4")
+    signatures = [probe_streams(str(p)) for p in paths]
+    if len(set(signatures)) > 1:
+        logging.warning(f"⚠️ {out.name} 的來源編碼參數不一致，改成重新編碼")
+        concat_reencode(paths, tmp, signatures)
+        tmp.replace(out)
         return
 
-    series_mp4 = series_dir / f"series_{s}.mp4"
-    if not series_mp4.exists():
-        txt = series_dir / f"series_{s}.txt"
-        with txt.open("w") as f:
-            for e in eps:
-                f.write(f"file '{Path(e['video_path']).absolute()}'\n")
+    txt = out.with_suffix(".txt")
+    cwd = Path.cwd()
+    with txt.open("w") as f:
+        # concat demuxer 的路徑用單引號包，路徑裡的 ' 要寫成 '\''
+        f.writelines(
+            "file '" + str(cwd / p).replace("'", "'\\''") + "'\n"
+            for p in paths
+        )
+    try:
         subprocess.run(
-            ["ffmpeg","-f","concat","-safe","0","-i",str(txt),"-c","copy",str(series_mp4)],
+            ["ffmpeg","-y","-f","concat","-safe","0","-i",str(txt),"-c","copy",str(tmp)],
             check=True
         )
+    finally:
         txt.unlink()
+    tmp.replace(out)
+
+def concat_reencode(paths: List[Path], out: Path, signatures: List[tuple]):
+    """
+    用 concat filter 重新編碼接起來
+    demuxer 中途換解析度、取樣率時 encoder 會出問題，所以每一集先各自統一成第一集的規格再接
+    frame rate 也要統一，不然各集 fps 不同時 ffmpeg 會退回 25 fps，畫格被丟掉或重複
+    有任何一集沒有聲音就整個不帶聲音（低 fps proxy 本來就沒有）
+    """
+    # 沒有影像軌的檔案接不進 concat filter，先講清楚是哪個檔案，不要丟一個看不懂的 filter 錯誤
+    no_video = [p.name for p, (video, _) in zip(paths, signatures) if not (video[1] and video[2])]
+    if no_video:
+        raise ValueError(f"{out.name} 的來源讀不到影像軌: {', '.join(no_video)}")
+    _, width, height, _ = signatures[0][0]
+    first = _first_stream(probe(str(paths[0])), "video") or {}
+    rate = first.get("avg_frame_rate")
+    if rate in (None, "0/0"):
+        rate = first.get("r_frame_rate", "24000/1001")
+    has_audio = all(audio[0] for _, audio in signatures)
+    inputs, filters, pads = [], [], []
+    for i, p in enumerate(paths):
+        inputs += ["-i", str(p)]
+        filters.append(f"[{i}:v:0]fps={rate},scale={width}:{height},setsar=1[v{i}]")
+        pads.append(f"[v{i}]")
+        if has_audio:
+            filters.append(f"[{i}:a:0]aresample=48000,aformat=channel_layouts=stereo[a{i}]")
+            pads.append(f"[a{i}]")
+    a = 1 if has_audio else 0
+    filters.append("".join(pads) + f"concat=n={len(paths)}:v=1:a={a}[v]" + ("[a]" if has_audio else ""))
+    maps = ["-map","[v]"] + (["-map","[a]","-c:a","aac"] if has_audio else [])
+    subprocess.run(
+        ["ffmpeg","-y",*inputs,"-filter_complex",";".join(filters),*maps,
+         "-r",rate,"-c:v","libx264","-preset","veryfast","-crf","23",str(out)],
+        check=True
+    )
+
+def series_done(series: str) -> bool:
+    """series-level 做好了：json 在，而且不是舊版失敗時留下的 {"error": ...}"""
+    s = safe_name(series)
+    series_json = VIDEO_ROOT / s / f"series_{s}.json"
+    if not series_json.exists():
+        return False
+    try:
+        query = read_json(series_json).get("query", {})
+    except (OSError, EOFError, ValueError, AttributeError) as e:
+        # 檔案壞掉（寫一半、手動改壞）就當作沒做過，重做這個 series，不要讓整個 main() 掛掉
+        logging.warning(f"⚠️ 無法讀取 {series_json}，重做這個 series: {e}")
+        return False
+    return isinstance(query, dict) and "error" not in query
+
+def prepare_series_video(series: str, eps: List[Dict[str, Any]]) -> Path:
+    """原檔直接 stream copy 接起來，來源都沒變就不用重做"""
+    s = safe_name(series)
+    series_dir = VIDEO_ROOT / s
+    series_dir.mkdir(parents=True, exist_ok=True)
+
+    sources = [Path(e["video_path"]) for e in eps]
+    series_mp4 = series_dir / f"series_{s}.mp4"
+    if is_stale(series_mp4, sources):
+        concat_videos(sources, series_mp4)
+    return series_mp4
+
+def prepare_series_proxy(series: str, eps: List[Dict[str, Any]]) -> Path:
+    """低 fps 版本一集一集轉好 cache 起來再接，多一集只要多轉那一集"""
+    s = safe_name(series)
+    proxy_dir = PROXY_ROOT / s
+    proxy_dir.mkdir(parents=True, exist_ok=True)
+    parts = []
+    for e in eps:
+        part = proxy_dir / f"series_part_{s}_{e['episode_id']}_low_fps.mp4"
+        if is_stale(part, [Path(e["video_path"])]):
+            down_video_fps(Path(e["video_path"]), part, fps=0.2)
+        parts.append(part)
+
+    low = VIDEO_ROOT / s / f"series_{s}_low_fps.mp4"
+    if is_stale(low, parts):
+        concat_videos(parts, low)
+    return low
+
+def process_series(series: str, eps: List[Dict[str, Any]]):
+    s = safe_name(series)
+    series_dir = VIDEO_ROOT / s
+    series_dir.mkdir(parents=True, exist_ok=True)
+
+    series_json = series_dir / f"series_{s}.json"
+    if series_done(series):
+        return
 
-    low = series_dir / f"series_{s}_low_fps.mp4"
-    if not low.exists():
-        subprocess.run([
-            "ffmpeg","-y","-i",str(series_mp4),
-            "-vf","fps=0.2","-an","-c:v","libx264","-crf","32","-preset","veryfast",
-            str(low)
-        ], check=True)
+    # main() 通常已經在背景準備好了，這裡只是確認（沒變就不會重做）
+    series_mp4 = prepare_series_video(series, eps)
+    low = prepare_series_proxy(series, eps)
 
     file_uri = upload_file_to_gemini(str(low))
     if file_uri:
         def _call_series(c):
             return generate_series_queries(client=c, file_uri=file_uri)
         time.sleep(1)
-        series_query = retry(_call_series, f"series {series}") or {"error": "gen failed"}
+        series_query = retry(_call_series, f"series {series}")
     else:
         log_error(f"series upload {series}", "upload to gemini failed")
-        series_query = {"error": "upload failed"}
+        series_query = None
 
-    api = HfApi(token=HF_TOKEN)
-    api.upload_file(
-        path_or_fileobj=str(series_mp4),
-        repo_id=HF_SER,
-        path_in_repo=f"videos/{s}/series_{s}.mp4",
-        repo_type="dataset",
+    commit_files(
+        HF_SER,
+        [(f"videos/{s}/series_{s}.mp4", series_mp4)],
+        f"{series} series video",
     )
 
-    series_json.write_text(json.dumps({
+    # 失敗就不寫 json（錯誤已經記在 error log），下次執行會再做一次
+    if series_query is None:
+        return
+    write_json(series_json, {
         "file_name": f"videos/{s}/series_{s}.mp4",
         "series_name": series,
         "query": series_query,
-    }, ensure_ascii=False, indent=2), encoding="utf-8")
-
-    update_series_metadata(HF_TOKEN)
+    })
+    mark_dirty("series")
 
 # ========= dataset =========
+GROUPS_SNAPSHOT = CACHE_ROOT / "groups.pkl"
+GROUPS_SNAPSHOT_TTL = 7 * 24 * 3600  # 秒
+
+def _load_groups_snapshot() -> Optional[Dict[str, List[Dict[str, Any]]]]:
+    """讀本機的分組快照；太舊或影片檔不見了（HF cache 被清掉）就當作沒有"""
+    if not GROUPS_SNAPSHOT.exists():
+        return None
+    if time.time() - GROUPS_SNAPSHOT.stat().st_mtime > GROUPS_SNAPSHOT_TTL:
+        return None
+    try:
+        with GROUPS_SNAPSHOT.open("rb") as f:
+            groups = pickle.load(f)
+    except Exception as e:
+        logging.warning(f"⚠️ 無法讀取 {GROUPS_SNAPSHOT}: {e}")
+        return None
+    if not all(Path(ep["video_path"]).exists() for eps in groups.values() for ep in eps):
+        return None
+    return groups
+
 def load_and_group_dataset() -> Dict[str, List[Dict[str, Any]]]:
-    ds = load_dataset(DATASET, SUBSET, split="train").cast_column("video", Video(decode=False))
-    groups: Dict[str, List[Dict[str, Any]]] = {}
-    for r in ds:
-        groups.setdefault(r["series_name"], []).append({
-            "episode_id": r["episode_name"],
-            "series_name": r["series_name"],
-            "video_path": r["video"]["path"],
-            "release_date": r.get("release_date"),
+    groups = _load_groups_snapshot()
+    if groups is not None:
+        return groups
+
+    ds = load_dataset(DATASET, SUBSET, split="train")
+    # 直接從底層 arrow table 整欄拿，不走一列一列的 python 格式化
+    # video 欄只取 path，不會把可能內嵌的影片 bytes 也轉成 python 物件
+    table = ds.data
+    series_names = table.column("series_name").to_pylist()
+    episode_names = table.column("episode_name").to_pylist()
+    video_paths = [p for chunk in table.column("video").chunks for p in chunk.field("path").to_pylist()]
+    if "release_date" in table.column_names:
+        dates = table.column("release_date").to_pylist()
+    else:
+        dates = [None] * len(series_names)
+
+    groups = {}
+    for series, ep, path, date in zip(series_names, episode_names, video_paths, dates):
+        groups.setdefault(series, []).append({
+            "episode_id": ep,
+            "series_name": series,
+            "video_path": path,
+            "release_date": date,
         })
+
+    with GROUPS_SNAPSHOT.open("wb") as f:
+        pickle.dump(groups, f)
     return groups
 
 # ========= main =========
+def finish_series(series: str, ep_futures: List[tuple], prep_futures: List[Any], eps: List[Dict[str, Any]]):
+    """等這個 series 的 episode 都做完，上傳 segment/episode，同時做 series-level"""
+    logging.info(f"=== {series} ===")
+    for ep, fut in ep_futures:
+        try:
+            fut.result()
+        except Exception as e:
+            logging.error(f"episode {series} {ep['episode_id']} failed: {e}")
+            log_error(f"episode {series} {ep['episode_id']}", str(e))
+
+    # segment/episode 上傳 HF 和 series-level 的 Gemini 互不相干，上傳丟到旁邊跑
+    with ThreadPoolExecutor(max_workers=1) as uploader:
+        up_fut = uploader.submit(upload_one_series, series)
+
+        for fut in prep_futures:
+            try:
+                fut.result()
+            except Exception as e:
+                logging.error(f"series video {series} failed: {e}")
+        process_series(series, eps)
+        up_fut.result()
+
+    # 已經很久沒更新 metadata 的話順便更新，HF 上的 dataset 才看得到進度
+    if time.monotonic() - _last_flush > METADATA_FLUSH_INTERVAL:
+        flush_metadata()
+
+def sort_episodes(eps: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    try:
+        return sorted(eps, key=lambda e: float(e["episode_id"]))
+    except Exception:
+        return eps
+
 def main():
     # 確保 HF repo 存在
     for r in [HF_SEG, HF_EP, HF_SER]:
-        create_repo(r, token=HF_TOKEN, repo_type="dataset", exist_ok=True)
+        HF_API.create_repo(r, repo_type="dataset", exist_ok=True)
 
     groups = load_and_group_dataset()
 
-    for series, eps in groups.items():
-        logging.info(f"=== {series} ===")
-
-        # 跑這個 series 的所有 episode
-        for ep in eps:
-            run_one_episode(series, ep)
+    # 每一集彼此獨立、主要都在等 Gemini，所以跨 series 一起丟進 pool
+    # pool 大小跟 key 數走，開太多只會一直吃 429
+    n_eps = sum(len(eps) for eps in groups.values())
+    workers = max(1, min(n_eps, len(GEMINI_KEYS) * 2))
+    # metadata 只在最後更新一次；中途出錯也要把已經上傳的部分補上
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor, \
+             ThreadPoolExecutor(max_workers=SERIES_PREP_WORKERS) as series_pool:
+            futures = {
+                series: [(ep, executor.submit(run_one_episode, series, ep)) for ep in eps]
+                for series, eps in groups.items()
+            }
 
-        # 上傳這個 series 的 segment/episode
-        upload_one_series(series)
+            # series 影片和低 fps 版本都只需要原始檔，不用等 episode 的 Gemini 結果
+            # 先在背景接好、轉好，跟 episode 的工作重疊，輪到 series-level 時通常已經好了
+            eps_sorted = {series: sort_episodes(eps) for series, eps in groups.items()}
+            series_prep = {
+                series: [
+                    series_pool.submit(prepare_series_video, series, eps_sorted[series]),
+                    series_pool.submit(prepare_series_proxy, series, eps_sorted[series]),
+                ]
+                for series in groups
+                if not series_done(series)
+            }
 
-        # 再做 series-level
-        try:
-            eps_sorted = sorted(eps, key=lambda e: float(e["episode_id"]))
-        except Exception:
-            eps_sorted = eps
-        process_series(series, eps_sorted)
+            # 每個 series 等自己的 episode 做完就收尾，不用排隊等前面的 series
+            # 收尾大多在等 HF / Gemini，丟到另一個 pool，彼此的上傳和 PROCESSING 就能重疊
+            # 跟 episode 一樣照 key 數開，series-level 的請求才不會只有一兩個在跑
+            final_workers = max(1, min(len(groups), len(GEMINI_KEYS)))
+            with ThreadPoolExecutor(max_workers=final_workers) as final_pool:
+                finals = {
+                    series: final_pool.submit(
+                        finish_series, series, futures[series], series_prep.get(series, []), eps_sorted[series]
+                    )
+                    for series in groups
+                }
+                for series, fut in finals.items():
+                    try:
+                        fut.result()
+                    except Exception as e:
+                        logging.error(f"series {series} failed: {e}")
+                        log_error(f"series {series}", str(e))
+    finally:
+        _segment_pool.shutdown()
+        _cut_pool.shutdown()
+        flush_file_meta()
+        flush_upload_index()
+        flush_metadata()
 
     logging.info("✅ all done")
 
@@ -7,22 +7,23 @@ Segment Level 處理模組：處理動畫片段的查詢生成
 主要功能：
 - 定義片段級別的查詢生成 schema
 - 提供生成查詢的提示詞
-- 呼叫 Gemini API 進行內容分析
+- 呼叫 Gemini API 進行內容分析（單一片段，或同一集的多個片段一次送）
 """
 
-import json
 import time
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Tuple
 
 import google.genai as genai
 from google.genai import types
 
-
-# ================== 自定義異常 ==================
-
-class BlockedContentError(Exception):
-    """當內容被 Gemini API 阻止時拋出"""
-    pass
+from gemini_common import (
+    BadResponseError,
+    BlockedContentError,
+    build_template,
+    generate_json,
+    parse_json_response,
+    raise_empty_response,
+)
 
 
 # ================== Schema 定義 ==================
@@ -130,12 +131,40 @@ PROMPT = """你會看到「一小段實際動畫影片片段」，你的任務
 """
 
 
+# 一次送同一集的多個片段時用的 schema：每個片段一組 SEGMENT_SCHEMA
+SEGMENT_BATCH_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "segments": {
+            "type": "array",
+            "items": SEGMENT_SCHEMA,
+            "description": "依照片段給的順序，每個片段一組查詢語句。",
+        },
+    },
+    "required": ["segments"],
+}
+
+# 一次送多個片段時，接在原本提示詞後面的說明
+BATCH_PROMPT = PROMPT + """
+這次會依序給你同一集裡的好幾個片段，每個片段前面會標「片段 N」。
+請把每個片段當成各自獨立的一小段影片，分別依照上面的規則產生查詢，
+不要把其他片段的內容寫進這個片段。
+segments 陣列的順序要跟片段順序一致，數量也要一樣。
+"""
+
+
+# 固定的提示詞與設定只建一次
+_PROMPT_PART, _CONFIG = build_template(PROMPT, SEGMENT_SCHEMA)
+_BATCH_PROMPT_PART, _BATCH_CONFIG = build_template(BATCH_PROMPT, SEGMENT_BATCH_SCHEMA)
+
+
 # ================== Gemini API 呼叫 ==================
 
 def generate_segment_queries(
     client: genai.Client,
-    file_uri: str,
+    file_uri: Optional[str] = None,
     model_name: str = "models/gemini-2.5-flash",
+    video_bytes: Optional[bytes] = None,
 ) -> Dict[str, Any]:
     """
     使用 Gemini 生成片段級別的查詢語句
@@ -144,59 +173,64 @@ def generate_segment_queries(
         client: Gemini API 客戶端
         file_uri: 影片檔案 URI
         model_name: 使用的模型名稱
+        video_bytes: 直接內嵌的影片內容（給了就不用 file_uri）
 
     Returns:
         包含查詢語句的字典
     """
 
+    resp = generate_json(
+        client, file_uri, _PROMPT_PART, _CONFIG, fps=1, model_name=model_name, video_bytes=video_bytes
+    )
+    data = parse_json_response(resp, SEGMENT_SCHEMA)
+    if data is not None:
+        return data
+
+    raise_empty_response(resp)
+
+
+def generate_segment_queries_batch(
+    client: genai.Client,
+    file_uri: str,
+    windows: List[Tuple[float, float]],
+    model_name: str = "models/gemini-2.5-flash",
+) -> List[Dict[str, Any]]:
+    """
+    一個請求生成同一集裡多個片段的查詢語句
+    影片只傳整集一次，用 start_offset / end_offset 指定每個片段的區間
+
+    Args:
+        client: Gemini API 客戶端
+        file_uri: 整集影片的檔案 URI
+        windows: 每個片段的 (開始秒數, 結束秒數)
+        model_name: 使用的模型名稱
+
+    Returns:
+        跟 windows 順序一致的查詢語句字典列表
+    """
+    parts = [_BATCH_PROMPT_PART]
+    for i, (start, end) in enumerate(windows):
+        parts.append(types.Part(text=f"片段 {i + 1}"))
+        parts.append(types.Part(
+            file_data=types.FileData(file_uri=file_uri),
+            video_metadata=types.VideoMetadata(
+                start_offset=f"{start:.2f}s",
+                end_offset=f"{end:.2f}s",
+                fps=1,
+            ),
+        ))
+
     resp = client.models.generate_content(
         model=model_name,
-        contents=types.Content(
-            parts=[
-                types.Part(
-                    file_data=types.FileData(file_uri=file_uri),
-                    video_metadata=types.VideoMetadata(fps=1)
-                ),
-                types.Part(text=PROMPT),
-            ]
-        ),
-        config={
-            "response_mime_type": "application/json",
-            "response_schema": SEGMENT_SCHEMA,
-        }
+        contents=types.Content(parts=parts),
+        config=_BATCH_CONFIG,
     )
-    
-    # 嘗試多種方式獲取響應內容
-    if resp.text:
-        return json.loads(resp.text)
-    elif hasattr(resp, 'candidates') and resp.candidates:
-        candidate = resp.candidates[0]
-        if hasattr(candidate, 'content') and candidate.content:
-            if hasattr(candidate.content, 'parts') and candidate.content.parts:
-                text = candidate.content.parts[0].text
-                if text:
-                    return json.loads(text)
-    
-    # 檢查是否有 prompt_feedback (安全過濾或其他原因)
-    error_info = []
-    is_blocked = False
-    print(resp)
-    if hasattr(resp, 'prompt_feedback'):
-        feedback = resp.prompt_feedback
-        if hasattr(feedback, 'block_reason') and feedback.block_reason:
-            is_blocked = True
-            error_info.append(f"block_reason: {feedback.block_reason}")
-        error_info.append(f"prompt_feedback: {resp.prompt_feedback}")
-        
-    if hasattr(resp, 'candidates'):
-        if not resp.candidates:
-            error_info.append("candidates 為空")
-        else:
-            for idx, candidate in enumerate(resp.candidates):
-                if hasattr(candidate, 'finish_reason'):
-                    error_info.append(f"candidate {idx} finish_reason: {candidate.finish_reason}")
-                if hasattr(candidate, 'safety_ratings'):
-                    error_info.append(f"candidate {idx} safety_ratings: {candidate.safety_ratings}")
-    
-    raise ValueError("Gemini API 返回空響應")
-
+    data = parse_json_response(resp, SEGMENT_BATCH_SCHEMA)
+    if data is None:
+        # 整批被擋的話丟 BlockedContentError，不重試，直接退回一段一段做
+        raise_empty_response(resp)
+
+    segments = data["segments"]
+    if len(segments) != len(windows):
+        raise BadResponseError(f"片段數量不符：要 {len(windows)} 組，拿到 {len(segments)} 組")
+    return segments
@@ -20,10 +20,13 @@ def upload_with_unicode_fix(client, path: str):
         p.name.encode("ascii")
         upload_path = str(p)
     except UnicodeEncodeError:
-        # 複製到臨時檔案,使用純 ASCII 檔名
-        print(f"⚠️ 檔名包含中文,複製到臨時檔案")
+        # 用純 ASCII 檔名的 hardlink 指到同一個檔案,不行才複製
+        print(f"⚠️ 檔名包含中文,建立臨時檔案")
         tmp = Path(tempfile.gettempdir()) / f"tmp_{int(time.time()*1000)}{p.suffix}"
-        shutil.copy2(p, tmp)
+        try:
+            os.link(p, tmp)
+        except OSError:
+            shutil.copy2(p, tmp)
         upload_path = str(tmp)
         print(f"臨時檔案: {upload_path}")
     
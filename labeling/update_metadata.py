@@ -1,11 +1,14 @@
 # update_hf_metadata.py
 import os
-import json
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
+import orjson
 from huggingface_hub import HfApi
 
+from json_cache import read_json
+
 # === 基本設定 ===
 CACHE_DIR = Path("./cache_gemini_video")
 VIDEO_DIR = CACHE_DIR / "videos"
@@ -61,6 +64,23 @@ def sort_items(items: List[Dict[str, Any]], level: str) -> List[Dict[str, Any]]:
     return items
 
 
+_parsed: Dict[Path, Tuple[float, Any]] = {}  # cache 檔 -> (mtime, 解析結果)
+
+
+def read_cached(path: Path) -> Any:
+    """
+    同一次執行裡會 flush 好幾次 metadata，沒變過的 cache 檔不用每次重新讀、重新解析
+    cache 檔都是 atomic 寫入，有改過 mtime 一定會變
+    """
+    mtime = path.stat().st_mtime
+    hit = _parsed.get(path)
+    if hit and hit[0] == mtime:
+        return hit[1]
+    data = read_json(path)
+    _parsed[path] = (mtime, data)
+    return data
+
+
 def collect_metadata(level: str) -> List[Dict[str, Any]]:
     """三種等級都從 videos/<series> 底下找"""
     items: List[Dict[str, Any]] = []
@@ -78,8 +98,7 @@ def collect_metadata(level: str) -> List[Dict[str, Any]]:
             continue
         for path in series_dir.glob(pattern):
             try:
-                with path.open("r", encoding="utf-8") as f:
-                    data = json.load(f)
+                data = read_cached(path)
                 if isinstance(data, list):
                     for item in data:
                         items.append(ensure_file_name(item, level))
@@ -90,18 +109,19 @@ def collect_metadata(level: str) -> List[Dict[str, Any]]:
     return items
 
 
-def write_jsonl(local_path: Path, items: List[Dict[str, Any]]):
-    local_path.parent.mkdir(parents=True, exist_ok=True)
-    with local_path.open("w", encoding="utf-8") as f:
-        for item in items:
-            json.dump(item, f, ensure_ascii=False)
-            f.write("\n")
+def to_jsonl(items: List[Dict[str, Any]]) -> bytes:
+    return b"".join(orjson.dumps(item) + b"\n" for item in items)
+
+
+@lru_cache(maxsize=None)
+def hf_api(hf_token: str) -> HfApi:
+    """同一個 token 共用一個 HfApi"""
+    return HfApi(token=hf_token)
 
 
-def upload_jsonl_to_hf(repo_id: str, local_path: Path, hf_token: str):
-    api = HfApi(token=hf_token)
-    api.upload_file(
-        path_or_fileobj=str(local_path),
+def upload_jsonl_to_hf(repo_id: str, data: bytes, hf_token: str):
+    hf_api(hf_token).upload_file(
+        path_or_fileobj=data,
         repo_id=repo_id,
         path_in_repo=METADATA_FILENAME,
         repo_type="dataset",
@@ -109,40 +129,50 @@ def upload_jsonl_to_hf(repo_id: str, local_path: Path, hf_token: str):
     print(f"✅ 已上傳 {METADATA_FILENAME} 至 {repo_id}")
 
 
-def update_segment_metadata(hf_token: str):
-    items = collect_metadata("segment")
+def local_metadata_path(level: str) -> Path:
+    """上一次成功上傳的 metadata.jsonl 留一份在本機"""
+    return METADATA_CACHE_DIR / f"{level}_{METADATA_FILENAME}"
+
+
+def build_metadata(level: str) -> Optional[bytes]:
+    """
+    收集某個等級的 metadata，組成 jsonl 內容
+    沒資料，或跟上一次上傳的一模一樣，就回 None，不用再傳一次
+    """
+    items = collect_metadata(level)
     if not items:
-        print("⚠️ 沒有 segment metadata。")
+        print(f"⚠️ 沒有 {level} metadata。")
+        return None
+    data = to_jsonl(sort_items(items, level))
+    local_path = local_metadata_path(level)
+    if local_path.exists() and local_path.read_bytes() == data:
+        print(f"📝 {level} metadata 沒有變動，跳過上傳")
+        return None
+    print(f"📝 {level} metadata: {len(items)} 筆")
+    return data
+
+
+def update_metadata(level: str, repo_id: str, hf_token: str):
+    data = build_metadata(level)
+    if data is None:
         return
-    items = sort_items(items, "segment")
-    local_path = METADATA_CACHE_DIR / f"segment_{METADATA_FILENAME}"
-    write_jsonl(local_path, items)
-    upload_jsonl_to_hf(HF_REPO_SEGMENT, local_path, hf_token)
-    print(f"📝 segment metadata: {len(items)} 筆")
+    upload_jsonl_to_hf(repo_id, data, hf_token)
+    # 上傳成功才更新本機這份，上傳失敗下次還會再傳
+    local_path = local_metadata_path(level)
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+    local_path.write_bytes(data)
+
+
+def update_segment_metadata(hf_token: str):
+    update_metadata("segment", HF_REPO_SEGMENT, hf_token)
 
 
 def update_episode_metadata(hf_token: str):
-    items = collect_metadata("episode")
-    if not items:
-        print("⚠️ 沒有 episode metadata。")
-        return
-    items = sort_items(items, "episode")
-    local_path = METADATA_CACHE_DIR / f"episode_{METADATA_FILENAME}"
-    write_jsonl(local_path, items)
-    upload_jsonl_to_hf(HF_REPO_EPISODE, local_path, hf_token)
-    print(f"📝 episode metadata: {len(items)} 筆")
+    update_metadata("episode", HF_REPO_EPISODE, hf_token)
 
 
 def update_series_metadata(hf_token: str):
-    items = collect_metadata("series")
-    if not items:
-        print("⚠️ 沒有 series metadata。")
-        return
-    items = sort_items(items, "series")
-    local_path = METADATA_CACHE_DIR / f"series_{METADATA_FILENAME}"
-    write_jsonl(local_path, items)
-    upload_jsonl_to_hf(HF_REPO_SERIES, local_path, hf_token)
-    print(f"📝 series metadata: {len(items)} 筆")
+    update_metadata("series", HF_REPO_SERIES, hf_token)
 
 
 def main():
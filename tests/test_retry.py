@@ -0,0 +1,115 @@
+import importlib
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+LABELING = Path(__file__).resolve().parents[1] / "labeling"
+
+
+@pytest.fixture(scope="module")
+def main(tmp_path_factory):
+    # main 在 import 時就會在目前目錄建 cache 資料夾、為每把 key 建 client
+    # 環境變數、sys.path、目前目錄都在這個 module 的測試跑完後還原
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path_factory.mktemp("run"))
+        mp.setenv("GEMINI_API_KEY", "test-key")
+        mp.setenv("HF_TOKEN", "test-token")
+        mp.syspath_prepend(str(LABELING))
+        yield importlib.import_module("main")
+
+
+SCHEMA = {
+    "type": "object",
+    "properties": {"query": {"type": "string"}},
+    "required": ["query"],
+}
+
+
+def test_schema_mismatch_is_retried(main, monkeypatch):
+    from gemini_common import parse_json_response
+
+    monkeypatch.setattr(main, "_backoff", lambda rs: 0)
+    replies = iter(['{"other": 1}', '{"query": "ok"}'])
+    calls = []
+
+    def call(client):
+        calls.append(client)
+        return parse_json_response(SimpleNamespace(text=next(replies)), SCHEMA)
+
+    assert main.retry(call, "test") == {"query": "ok"}
+    assert len(calls) == 2
+
+
+def test_schema_mismatch_raises_bad_response(main):
+    from gemini_common import BadResponseError, check_schema
+
+    with pytest.raises(BadResponseError):
+        check_schema({"other": 1}, SCHEMA)
+
+
+@pytest.mark.parametrize("rpm", [0, 60])
+def test_gives_up_when_every_key_is_cooling_down(main, monkeypatch, rpm):
+    monkeypatch.setattr(main, "GEMINI_RPM", rpm)
+    monkeypatch.setattr(main, "_next_slot", {})
+    monkeypatch.setattr(main, "_cooldown_until", {})
+    for key in main.GEMINI_KEYS:
+        main.cool_down(key, main.DAILY_QUOTA_COOLDOWN)
+    calls = []
+
+    start = main.time.monotonic()
+    assert main.retry(calls.append, "test") is None
+    assert calls == []
+    assert main.time.monotonic() - start < 1
+
+
+def test_blocked_batch_is_not_retried(main):
+    from segment_processor import BlockedContentError, generate_segment_queries_batch
+
+    blocked = SimpleNamespace(
+        text=None,
+        candidates=[],
+        prompt_feedback=SimpleNamespace(block_reason="PROHIBITED_CONTENT"),
+    )
+    client = SimpleNamespace(models=SimpleNamespace(generate_content=lambda **kw: blocked))
+
+    with pytest.raises(BlockedContentError):
+        generate_segment_queries_batch(client, "files/x", [(0, 60)])
+    assert main._is_fatal_error(BlockedContentError("blocked"))
+
+
+def test_corrupt_series_json_is_redone(main):
+    series_dir = main.VIDEO_ROOT / main.safe_name("s")
+    series_dir.mkdir(parents=True, exist_ok=True)
+    (series_dir / "series_s.json").write_bytes(b'{"query": {"a"')
+    assert main.series_done("s") is False
+
+
+def test_upload_index_flush_drops_expired(main, monkeypatch):
+    now = main.time.time()
+    monkeypatch.setattr(main, "_upload_index", {
+        "old": {"name": "files/old", "uri": "u1", "expires": now - 1},
+        "new": {"name": "files/new", "uri": "u2", "expires": now + 3600},
+    })
+    monkeypatch.setattr(main, "_upload_index_dirty", True)
+    main.flush_upload_index()
+    assert list(main.read_json(main.UPLOAD_INDEX)) == ["new"]
+
+
+def test_rebuilt_file_is_not_served_from_uri_cache(main, monkeypatch, tmp_path):
+    video = tmp_path / "proxy.mp4"
+    video.write_bytes(b"old")
+    uploads = []
+
+    def fake_submit(path):
+        uploads.append(path)
+        return SimpleNamespace(name=f"files/{len(uploads)}")
+
+    monkeypatch.setattr(main, "submit_upload", fake_submit)
+    monkeypatch.setattr(main, "wait_active", lambda obj, path: obj.name)
+    monkeypatch.setattr(main, "_reuse_uploaded", lambda digest: None)
+
+    assert main.upload_file_to_gemini(str(video)) == "files/1"
+    assert main.upload_file_to_gemini(str(video)) == "files/1"
+    video.write_bytes(b"rebuilt")
+    assert main.upload_file_to_gemini(str(video)) == "files/2"